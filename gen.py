@@ -1,70 +1,132 @@
 import argparse
 import time
 import math
+import os
+import multiprocessing
+import numpy as np
 import torch
 from torch import nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from model import *
+from utils import BucketBatchSampler, seq_lengths, trim_collate
 from rdkit import Chem
 
 
+@torch.inference_mode()
 def evaluate(data_iter):
     model.eval()
     total_loss = 0
 
-    with torch.no_grad():
-
-        for data, label in data_iter:
-            targets = data[:, 1:]
-            inputs = data[:, :-1]
-            if torch.cuda.is_available()==True:
-                targets=targets.cuda()
-                inputs=inputs.cuda()
+    for data, label in data_iter:
+        if torch.cuda.is_available()==True:
+            data = data.to('cuda', non_blocking=True)
+        targets = data[:, 1:]
+        inputs = data[:, :-1]
 
+        with torch.autocast('cuda', enabled=torch.cuda.is_available()):
             outputs = model(inputs)
 
-            final_output = outputs.contiguous().view(-1, n_words)
-            final_target = targets.contiguous().view(-1)
+            final_output = outputs.reshape(-1, n_words)
+            final_target = targets.reshape(-1)
 
             loss = criterion(final_output, final_target)
-            total_loss += loss.item()
+        total_loss += loss.detach()
+
+    return (total_loss / len(data_iter)).item()
+
 
-    return total_loss / len(data_iter)
+def _valid(smi):
+    mol = Chem.MolFromSmiles(smi)
+    return (smi, Chem.MolToInchiKey(mol)) if mol else None
 
 
-def sample(idx2word, set_smi, num_samples):
+@torch.inference_mode()
+def sample(idx2word, set_smi, num_samples, batch_size=512, max_len=141):
     model.eval()
-    n_words = len(idx2word)
-    set_mols = [Chem.MolToInchiKey(Chem.MolFromSmiles(smi)) for smi in set_smi]
+    idx2word = np.array(idx2word)
+    pool = multiprocessing.Pool(max(os.cpu_count() // 2, 1))
+    set_mols = {r[1] for r in pool.map(_valid, set_smi) if r is not None}
+    device = 'cuda' if torch.cuda.is_available()==True else 'cpu'
     n = 0
-    new_mols = []
+    new_mols = set()
     new_smiles = []
     lss = 0
-    for i in range(num_samples):
-        input = torch.ones(1, 1, dtype=torch.long)
-        if torch.cuda.is_available()==True:
-            input=input.cuda()
-        
-        word = '&'
-        while word[-1] != '\n':
-            output = model(input)
-            final_output = output.contiguous().view(-1, n_words)
-            word_id = torch.multinomial(F.softmax(final_output[-1, :], dim=-1), num_samples=1).unsqueeze(0)
-            input = torch.cat((input, word_id), dim=1)
-            word += idx2word[word_id.item()]
-
-        if bool(Chem.MolFromSmiles(word[1:])):
+    n_done = 0
+
+    # capture one decoding step as a CUDA graph: every step has identical
+    # shapes, so replaying it removes the per-step Python/dispatch cost
+    graph = None
+    caches = model.init_caches(batch_size, device)
+    static_id = torch.ones(batch_size, 1, dtype=torch.long, device=device)
+    if torch.cuda.is_available()==True:
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(3):
+                with torch.autocast('cuda'):
+                    static_logits = model.forward_step(static_id, caches)
+        torch.cuda.current_stream().wait_stream(s)
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            with torch.autocast('cuda'):
+                static_logits = model.forward_step(static_id, caches)
+
+    def decode_step(word_id, chunk_caches):
+        if chunk_caches is caches:
+            static_id.copy_(word_id)
+            graph.replay()
+            return static_logits
+        with torch.autocast('cuda', enabled=torch.cuda.is_available()):
+            return model.forward_step(word_id, chunk_caches)
+
+    while n_done < num_samples:
+        b = min(batch_size, num_samples - n_done)
+        word_id = torch.ones(b, 1, dtype=torch.long, device=device)
+        if graph is not None and b == batch_size:
+            chunk_caches = caches
+            for cache in caches:
+                cache.zero_()
+        else:
+            chunk_caches = model.init_caches(b, device)
+        done = torch.zeros(b, 1, dtype=torch.bool, device=device)
+        ids = torch.zeros(b, max_len, dtype=torch.long, device=device)
+        for t in range(max_len):
+            logits = decode_step(word_id, chunk_caches)
+            # Gumbel-max draws the same categorical sample as
+            # softmax + multinomial with one elementwise op + argmax
+            gumbel = -torch.log(-torch.log(torch.rand_like(logits, dtype=torch.float)))
+            word_id = (logits + gumbel).argmax(dim=-1, keepdim=True)
+            word_id = word_id.masked_fill(done, 0)
+            ids[:, t] = word_id[:, 0]
+            done = done | (word_id == 0)
+            # done stays on device; poll it only every few steps so the
+            # loop is not host-synchronized per token
+            if (t + 1) % 8 == 0 and bool(done.all()):
+                break
+
+        candidates = []
+        for row in ids[:, :t + 1].cpu().numpy():
+            ends = np.nonzero(row == 0)[0]
+            if len(ends) == 0:
+                continue
+            candidates.append(''.join(idx2word[row[:ends[0]]]) + '\n')
+        for r in pool.imap_unordered(_valid, candidates, chunksize=64):
+            if r is None:
+                continue
+            word, mol = r
             n += 1
-            mol = Chem.MolToInchiKey(Chem.MolFromSmiles(word[1:]))
             if mol not in set_mols and mol not in new_mols:
-                new_mols += [mol]
-                new_smiles += [word[1:]]
-        if i != 0 and i % 10000 == 0:
+                new_mols.add(mol)
+                new_smiles += [word]
+
+        n_done += b
+        if n_done % 10000 < b and n_done >= 10000:
             print(len(new_smiles) - lss)
             lss = len(new_smiles)
+    pool.close()
+    pool.join()
     print(n / num_samples)
     return new_smiles
 
@@ -98,22 +160,41 @@ if __name__ == "__main__":
 
     print(args)
 
+    # fixed shapes per batch, so let cuDNN pick the fastest algorithm once
+    # and allow TF32 tensor-core kernels for matmul/conv
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     torch.manual_seed(1024)
     word2idx, idx2word = torch.load("data/opv_dic.pt")
     train_data, val_data, test_data = torch.load("data/opv_data.pt")
-    train_iter = DataLoader(train_data, args.batch_size, shuffle=True)
-    val_iter = DataLoader(val_data, args.batch_size, shuffle=False)
-    test_iter = DataLoader(test_data, args.batch_size, shuffle=False)
+    train_sampler = BucketBatchSampler(seq_lengths(train_data.tensors[0]), args.batch_size,
+                                       shuffle=True, drop_last=True)
+    train_iter = DataLoader(train_data, batch_sampler=train_sampler, collate_fn=trim_collate,
+                            pin_memory=True, num_workers=4, persistent_workers=True, prefetch_factor=2)
+    val_iter = DataLoader(val_data, args.batch_size, shuffle=False, collate_fn=trim_collate,
+                          pin_memory=True, num_workers=4, persistent_workers=True, prefetch_factor=2)
+    test_iter = DataLoader(test_data, args.batch_size, shuffle=False, collate_fn=trim_collate,
+                           pin_memory=True, num_workers=4, persistent_workers=True, prefetch_factor=2)
     n_words = len(word2idx)
 
     model = GEN(args.emsize, n_words, hid_size=args.nhid, n_levels=args.levels,
                 kernel_size=args.ksize, emb_dropout=args.emb_dropout, dropout=args.dropout )
     if torch.cuda.is_available()==True:
         model.cuda()
+        # batches come pre-bucketed to multiple-of-8 lengths with drop_last,
+        # so pin the compiled graphs to static shapes
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=True, dynamic=False)
 
     criterion = nn.CrossEntropyLoss()
-    optimizer = getattr(optim, args.optim)(model.parameters(), lr=args.lr)
+    if args.optim == 'Adam' and torch.cuda.is_available()==True:
+        # single fused CUDA kernel per step instead of one launch per tensor
+        optimizer = optim.Adam(model.parameters(), lr=args.lr, fused=True)
+    else:
+        optimizer = getattr(optim, args.optim)(model.parameters(), lr=args.lr, foreach=True)
     scheduler = ReduceLROnPlateau(optimizer, 'min')
+    scaler = torch.amp.GradScaler('cuda', enabled=torch.cuda.is_available())
 
     best_vloss = 100
     try:
@@ -123,26 +204,27 @@ if __name__ == "__main__":
             total_loss = 0
 
             for data, label in train_iter:
+                if torch.cuda.is_available()==True:
+                    data = data.to('cuda', non_blocking=True)
                 targets = data[:, 1:]
                 inputs = data[:, :-1]
-                if torch.cuda.is_available()==True:
-                    targets=targets.cuda()
-                    inputs=inputs.cuda()
 
-                optimizer.zero_grad()
-                outputs = model(inputs)
+                optimizer.zero_grad(set_to_none=True)
+                with torch.autocast('cuda', enabled=torch.cuda.is_available()):
+                    outputs = model(inputs)
 
-                final_output = outputs.contiguous().view(-1, n_words)
-                final_target = targets.contiguous().view(-1)
+                    final_output = outputs.reshape(-1, n_words)
+                    final_target = targets.reshape(-1)
 
-                loss = criterion(final_output, final_target)
-                loss.backward()
-                optimizer.step()
+                    loss = criterion(final_output, final_target)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
 
-                total_loss += loss.item()
+                total_loss += loss.detach()
 
             print('| epoch: {:3d} | train loss: {:5.6f} '.format
-                    (epoch, total_loss / len(train_iter)))
+                    (epoch, (total_loss / len(train_iter)).item()))
 
             val_loss = evaluate(val_iter)
             scheduler.step(val_loss)
@@ -162,6 +244,13 @@ if __name__ == "__main__":
         print('Exiting from training early')
 
     model.load_state_dict(torch.load("results/saved_models/" + str(args.levels) + args.save_name), strict=True)
+
+    # training is done: fold the weight_norm reparameterization into plain
+    # weights so inference skips the g * v/||v|| recompute every forward
+    for m in model.modules():
+        if isinstance(m, (nn.Conv1d, nn.Linear)) and hasattr(m, 'weight_g'):
+            torch.nn.utils.remove_weight_norm(m)
+
     test_loss = evaluate(test_iter)
     print('=' * 89)
     print('| End of training | test loss {:5.4f} | test ppl {:8.4f}'.format(test_loss, math.exp(test_loss)))
@@ -18,13 +18,37 @@ class ConvLayer(nn.Module):
         self.init_weights()
 
     def init_weights(self):
-        self.conv.weight.data.normal_(0, 0.01)
-        if self.trans is not None:
-            self.trans.weight.data.normal_(0, 0.01)
+        # runs on CPU at construction time, before the single .cuda() move
+        with torch.no_grad():
+            self.conv.weight.normal_(0, 0.01)
+            if self.trans is not None:
+                self.trans.weight.normal_(0, 0.01)
 
     def forward(self, x):
         y = self.conv(x)
-        out = self.glu(y[:,:,:-self.padding].contiguous()) if self.model=='Gen' else self.glu(y)
+        if self.model=='Gen':
+            # gate directly on the strided causal slice instead of
+            # materializing a contiguous (B, 2C, L) copy first
+            a, b = y[:,:,:-self.padding].chunk(2, dim=1)
+            out = a * torch.sigmoid(b)
+        else:
+            out = self.glu(y)
+        out = self.dropout(out)
+        if self.trans is not None:
+            x = self.trans(x)
+        return out + x
+
+    def init_cache(self, batch_size, device=None, dtype=None):
+        # the last receptive-field inputs; zeros reproduce the implicit
+        # left zero-padding of the full causal forward ('Gen' only)
+        return torch.zeros(batch_size, self.conv.in_channels, self.padding + 1,
+                           device=device, dtype=dtype)
+
+    def forward_step(self, x, cache):
+        cache[:, :, :-1] = cache[:, :, 1:].clone()
+        cache[:, :, -1:] = x
+        y = self.conv(cache)[:, :, self.padding:self.padding + 1]
+        out = self.glu(y)
         out = self.dropout(out)
         if self.trans is not None:
             x = self.trans(x)
@@ -51,6 +75,14 @@ class Encoder(nn.Module):
     def forward(self, x):
         return self.network(x)
 
+    def init_caches(self, batch_size, device=None, dtype=None):
+        return [layer.init_cache(batch_size, device, dtype) for layer in self.network]
+
+    def forward_step(self, x, caches):
+        for layer, cache in zip(self.network, caches):
+            x = layer.forward_step(x, cache)
+        return x
+
 # Generative model
 class GEN(nn.Module):
     def __init__(self, emb_size, dic_size, hid_size, n_levels, kernel_size=3, emb_dropout=0.1, dropout=0.2):
@@ -64,7 +96,17 @@ class GEN(nn.Module):
         emb = self.drop(self.emb(input))
         y = self.encoder(emb.transpose(1, 2))
         o = self.decoder(y.transpose(1, 2))
-        return o.contiguous()
+        return o
+
+    def init_caches(self, batch_size, device=None):
+        return self.encoder.init_caches(batch_size, device, self.emb.weight.dtype)
+
+    def forward_step(self, input, caches):
+        # input holds only the newest token ids, shape (batch, 1)
+        emb = self.drop(self.emb(input))
+        y = self.encoder.forward_step(emb.transpose(1, 2), caches)
+        o = self.decoder(y.transpose(1, 2))
+        return o[:, -1]
 
 # The decoder of prediction model
 class NNet(nn.Module):
@@ -77,8 +119,9 @@ class NNet(nn.Module):
         self.init_weights()
 
     def init_weights(self):
-        for i in range(self.n_hide + 1):
-            self.fcs[i].weight.data.normal_(0, 0.01)
+        with torch.no_grad():
+            for i in range(self.n_hide + 1):
+                self.fcs[i].weight.normal_(0, 0.01)
 
     def forward(self, x):
         for i in range(self.n_hide):
@@ -97,7 +140,8 @@ class PreDecoder(nn.Module):
         self.init_weights()
 
     def init_weights(self):
-        self.linear1.weight.data.normal_(0, 0.01)
+        with torch.no_grad():
+            self.linear1.weight.normal_(0, 0.01)
 
     def forward(self, emb, v):
         h = self.linear0(emb)
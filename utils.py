@@ -1,7 +1,59 @@
 import torch
 import pandas as pd
 from rdkit import Chem
-from torch.utils.data import TensorDataset, random_split
+from torch.utils.data import TensorDataset, random_split, Sampler
+
+
+def seq_lengths(data):
+    # true length of each padded row: tokens plus the terminating '\n',
+    # which shares id 0 with the padding
+    return ((data != 0).sum(dim=1) + 1).tolist()
+
+
+def trim_collate(batch):
+    # trim the batch to its longest sequence, rounded up to a multiple of 8
+    # so only a handful of distinct shapes reach the conv stack
+    data = torch.stack([d for d, t in batch])
+    labels = torch.stack([t for d, t in batch])
+    n = int((data != 0).sum(dim=1).max()) + 1
+    n = min(-(-n // 8) * 8, data.size(1))
+    return data[:, :n], labels
+
+
+class BucketBatchSampler(Sampler):
+    # groups sequences of similar length into batches, so trim_collate
+    # pads to the bucket boundary instead of the corpus maximum
+    def __init__(self, lengths, batch_size, bucket_width=8, shuffle=True, drop_last=False):
+        self.lengths = [int(l) for l in lengths]
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = torch.randperm(len(self.lengths)) if self.shuffle else torch.arange(len(self.lengths))
+        buckets = {}
+        for i in order.tolist():
+            buckets.setdefault(self.lengths[i] // self.bucket_width, []).append(i)
+
+        batches = []
+        for bucket in buckets.values():
+            for j in range(0, len(bucket), self.batch_size):
+                batch = bucket[j:j + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[k] for k in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        counts = {}
+        for l in self.lengths:
+            counts[l // self.bucket_width] = counts.get(l // self.bucket_width, 0) + 1
+        if self.drop_last:
+            return sum(c // self.batch_size for c in counts.values())
+        return sum(-(-c // self.batch_size) for c in counts.values())
 
 
 class Dictionary(object):